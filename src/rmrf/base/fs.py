@@ -1,16 +1,80 @@
 import hashlib
-import json
+import io
 import logging
-from collections import defaultdict
+import mmap
+import os
+import pickle
+import shutil
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
+from functools import cached_property, lru_cache
 from datetime import datetime
 from pathlib import Path
+from typing import TYPE_CHECKING
 
-import fitz
+import rmscene
 from rmscene import RootTextBlock, SceneGlyphItemBlock, SceneLineItemBlock, read_blocks
 from rmscene.scene_stream import Block
 
+try:
+    import orjson as _json
+
+    _JSON_ACCEPTS_BUFFER = True
+except ImportError:
+    import json as _json
+
+    _JSON_ACCEPTS_BUFFER = False
+
+if TYPE_CHECKING:
+    import fitz
+
 logger = logging.getLogger("rmrf")
+# Number of parsed .rm pages kept in memory per File
+PAGE_BLOCKS_CACHE_SIZE = 64
+# Bump when the cached hierarchy layout changes
+HIERARCHY_CACHE_VERSION = 1
+# Bump when the pickled .rm blocks may no longer match what rmscene produces
+BLOCKS_CACHE_VERSION = 1
+# JSON files at least this large are memory-mapped instead of read
+MMAP_JSON_THRESHOLD = 64 * 1024
+
+
+def load_json(path: str | Path) -> dict:
+    """Read a JSON file as bytes and decode it, preferring orjson when installed."""
+    with open(path, "rb") as f:
+        # orjson decodes straight from a mapped buffer, which saves copying large
+        # .content files; small ones are cheaper to read in one go
+        if _JSON_ACCEPTS_BUFFER and os.fstat(f.fileno()).st_size >= MMAP_JSON_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                with memoryview(mm) as buffer:
+                    return _json.loads(buffer)
+        return _json.loads(f.read())
+
+
+@lru_cache(maxsize=1)
+def rmscene_fingerprint() -> bytes:
+    """
+    Identify the installed rmscene by its version and the stat of its sources.
+
+    rmscene is often an editable checkout that changes without a version bump,
+    so pickled blocks are only reused when its sources are unchanged too.
+    """
+    package_dir = Path(rmscene.__file__).parent
+    digest = hashlib.blake2b(getattr(rmscene, "__version__", "").encode(), digest_size=16)
+    for path in sorted(package_dir.rglob("*.py")):
+        stat = path.stat()
+        digest.update(f"{path.name}:{stat.st_mtime_ns}:{stat.st_size};".encode())
+    return digest.digest()
+
+
+@lru_cache(maxsize=32)
+def _open_pdf(path: str, mtime_ns: int) -> "fitz.Document":
+    """Open a PDF once per path and modification time."""
+    # PyMuPDF is only loaded once a document is actually needed
+    import fitz
+
+    return fitz.open(path)
 
 
 @dataclass
@@ -20,78 +84,96 @@ class File:
     source_dir: Path | str
     cache_dir: Path | str
     date_format: str = "%Y-%m-%d %H:%M:%S:%f"
-    id2page: dict[str, int] = field(default_factory=dict)
-    page_tags: dict[int, set[str]] = field(default_factory=dict)
-    page_scroll: dict[int, int] = field(default_factory=dict)
     children: list["File"] = field(default_factory=list)
 
     def __post_init__(self):
         self.source_dir = Path(self.source_dir)
         self.cache_dir = Path(self.cache_dir)
-        self.read_page_map()
-        self.zid = hashlib.shake_256(self.name.encode()).hexdigest(6)
+        self._page_blocks: OrderedDict[int | None, list[Block]] = OrderedDict()
 
-    def read_page_map(self):
-        self.page_scroll = defaultdict(int)
-        if "cPages" in self.metadata and "pages" in self.metadata["cPages"]:
-            for i, page in enumerate(self.metadata["cPages"]["pages"]):
-                self.id2page[page["id"]] = i
-                if "verticalScroll" in page:
-                    self.page_scroll[i] = page["verticalScroll"]["value"]
+    # The page map is only built for the nodes that are actually exported
 
-        if "pages" in self.metadata:
-            for page, i in zip(
-                self.metadata["pages"], self.metadata["redirectionPageMap"]
-            ):
-                self.id2page[page] = i
+    @cached_property
+    def id2page(self) -> dict[str, int]:
+        pages = self.metadata.get("cPages", {}).get("pages", ())
+        id2page = {page["id"]: i for i, page in enumerate(pages)}
 
-        self.page_tags = defaultdict(set)
+        if "pages" in self.metadata:
+            id2page.update(
+                zip(self.metadata["pages"], self.metadata["redirectionPageMap"])
+            )
+        return id2page
+
+    @cached_property
+    def page_scroll(self) -> dict[int, int]:
+        page_scroll = defaultdict(int)
+        for i, page in enumerate(self.metadata.get("cPages", {}).get("pages", ())):
+            scroll = page.get("verticalScroll")
+            if scroll is not None:
+                page_scroll[i] = scroll["value"]
+        return page_scroll
+
+    @cached_property
+    def page_tags(self) -> dict[int, set[str]]:
+        page_tags = defaultdict(set)
         if "pageTags" in self.metadata:
             for item in self.metadata["pageTags"]:
                 page_idx = self.id2page[item["pageId"]]
-                self.page_tags[page_idx].add(item["name"])
+                page_tags[page_idx].add(item["name"])
+        return page_tags
 
-        self.rm_blocks = {}
+    @cached_property
+    def rm_paths(self) -> dict[int | None, Path]:
+        """Locations of the .rm pages; they are parsed on demand by get_page_blocks."""
+        rm_paths = {}
         highlight_dir = self.source_dir / self.id
-        if not highlight_dir.exists():
-            return
-
-        for rm_file in highlight_dir.glob("*.rm"):
-            basename = rm_file.name
-            page_id = basename.split(".")[0]
+        try:
+            with os.scandir(highlight_dir) as it:
+                entries = [e for e in it if e.name.endswith(".rm")]
+        except (FileNotFoundError, NotADirectoryError):
+            return rm_paths
+
+        for entry in entries:
+            name = entry.name
+            page_id = name[: name.index(".")]
             page_index = self.id2page.get(page_id, None)
-            with open(rm_file, "rb") as f:
-                self.rm_blocks[page_index] = list(read_blocks(f))
+            rm_paths[page_index] = Path(entry.path)
+        return rm_paths
 
-    @property
+    @cached_property
+    def zid(self) -> str:
+        # Names exported notes and static dirs, so the hash must stay stable
+        return hashlib.shake_256(self.name.encode()).hexdigest(6)
+
+    @cached_property
     def orientation(self):
         return self.metadata["orientation"]
 
-    @property
+    @cached_property
     def is_portrait(self):
         return self.orientation == "portrait"
 
-    @property
+    @cached_property
     def is_landscape(self):
         return self.orientation == "landscape"
 
-    @property
+    @cached_property
     def zoom_mode(self):
         return self.metadata["zoomMode"]
 
-    @property
+    @cached_property
     def zoom_scale(self):
         return self.metadata["customZoomScale"]
 
-    @property
+    @cached_property
     def margin(self):
         return self.metadata["margins"]
 
-    @property
+    @cached_property
     def center_x(self):
         return self.metadata["customZoomCenterX"]
 
-    @property
+    @cached_property
     def center_y(self):
         return self.metadata["customZoomCenterY"]
 
@@ -103,15 +185,15 @@ class File:
     def screen_width(self):
         return 1620
 
-    @property
+    @cached_property
     def zoom_height(self):
         return self.metadata["customZoomPageHeight"]
 
-    @property
+    @cached_property
     def zoom_width(self):
         return self.metadata["customZoomPageWidth"]
 
-    @property
+    @cached_property
     def created_time(self):
         result = datetime.fromtimestamp(
             int(self.metadata["createdTime"]) / 1000
@@ -121,43 +203,45 @@ class File:
             result = datetime.now().strftime(self.date_format)
         return result
 
-    @property
+    @cached_property
+    def last_modified(self) -> datetime:
+        return datetime.fromtimestamp(int(self.metadata["lastModified"]) / 1000)
+
+    @cached_property
     def last_modified_time(self):
-        return datetime.fromtimestamp(
-            int(self.metadata["lastModified"]) / 1000
-        ).strftime(self.date_format)
+        return self.last_modified.strftime(self.date_format)
 
-    @property
+    @cached_property
     def last_opened_time(self):
         return datetime.fromtimestamp(int(self.metadata["lastOpened"]) / 1000).strftime(
             self.date_format
         )
 
-    @property
+    @cached_property
     def is_collection(self):
         return self.metadata["type"] == "CollectionType"
 
-    @property
+    @cached_property
     def is_document(self):
         return self.metadata["type"] == "DocumentType"
 
-    @property
+    @cached_property
     def file_type(self):
         return self.metadata["fileType"]
 
-    @property
+    @cached_property
     def is_trash(self):
         return self.file_type == "trash"
 
-    @property
+    @cached_property
     def parent(self):
         return self.metadata["parent"]
 
-    @property
+    @cached_property
     def name(self):
         return self.metadata["visibleName"]
 
-    @property
+    @cached_property
     def deleted(self):
         return self.metadata.get("deleted", False) or self.parent == "trash"
 
@@ -181,18 +265,63 @@ class File:
         )
 
     @property
-    def doc(self) -> fitz.Document | None:
-        if self.file_type == "pdf" or self.file_type == "epub":
-            if (pdf_file := self.source_dir / f"{self.id}.pdf").exists():
-                doc = fitz.open(pdf_file)
-            else:
-                doc = None
-        else:
-            doc = None
-        return doc
+    def doc(self) -> "fitz.Document | None":
+        if self.file_type != "pdf" and self.file_type != "epub":
+            return None
+        pdf_file = self.source_dir / f"{self.id}.pdf"
+        try:
+            mtime_ns = pdf_file.stat().st_mtime_ns
+        except FileNotFoundError:
+            return None
+        return _open_pdf(str(pdf_file), mtime_ns)
 
     def get_page_blocks(self, page_idx: int) -> list[Block]:
-        return self.rm_blocks.get(page_idx, [])
+        if page_idx not in self.rm_paths:
+            return []
+
+        if page_idx in self._page_blocks:
+            self._page_blocks.move_to_end(page_idx)
+            return self._page_blocks[page_idx]
+
+        blocks = self.read_page_blocks(self.rm_paths[page_idx])
+
+        self._page_blocks[page_idx] = blocks
+        if len(self._page_blocks) > PAGE_BLOCKS_CACHE_SIZE:
+            self._page_blocks.popitem(last=False)
+        return blocks
+
+    @property
+    def blocks_cache_dir(self) -> Path:
+        """Pickled pages, one directory per document; FileSystem prunes deleted documents."""
+        return self.cache_dir / "blocks"
+
+    def read_page_blocks(self, rm_path: Path) -> list[Block]:
+        """Parse a .rm page, reusing the blocks pickled on a previous run if the file is unchanged."""
+        stat = rm_path.stat()
+        key = (BLOCKS_CACHE_VERSION, rmscene_fingerprint(), stat.st_mtime_ns, stat.st_size)
+        cache_path = self.blocks_cache_dir / self.id / f"{rm_path.stem}.pkl"
+
+        try:
+            with open(cache_path, "rb") as f:
+                if pickle.load(f) == key:
+                    return pickle.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.debug(f"Ignoring unreadable block cache {cache_path}: {e}")
+
+        # rmscene reads many small fields, so parse from memory rather than the file
+        blocks = list(read_blocks(io.BytesIO(rm_path.read_bytes())))
+
+        try:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(cache_path, "wb") as f:
+                pickle.dump(key, f, protocol=5)
+                pickle.dump(blocks, f, protocol=5)
+        except Exception as e:
+            logger.debug(f"Failed to write block cache {cache_path}: {e}")
+            cache_path.unlink(missing_ok=True)
+        return blocks
 
     def __len__(self):
         return len(self.id2page)
@@ -232,64 +361,149 @@ class FileSystem:
         return node
 
     def build_hierarchy(self):
+        children = defaultdict(list)
         for node in self.nodes.values():
-            parent_id = node.parent
-            if parent_id in self.nodes:
-                self.nodes[parent_id].children.append(node)
-            else:
-                self.root.children.append(node)
-
-    def get_metadata(self, file_id: str) -> dict:
-        path = self.source_dir / f"{file_id}.metadata"
-        if not path.exists():
-            return {}
-        with open(path, "r") as f:
-            return json.load(f)
-
-    def get_content(self, file_id: str) -> dict:
-        path = self.source_dir / f"{file_id}.content"
-        if not path.exists():
-            return {}
-        with open(path, "r") as f:
-            return json.load(f)
+            children[node.parent].append(node)
 
-    def parse_hierarchy(self, file_ids):
-        for file_id in file_ids:
-            metadata = self.get_metadata(file_id)
-            if not metadata:
-                logger.warning(f"Metadata for {file_id} not found")
+        for node_id, node in self.nodes.items():
+            node.children = children.pop(node_id, [])
+
+        # Whatever is left hangs off a parent that is not a live node
+        self.root.children = [node for nodes in children.values() for node in nodes]
+
+    @property
+    def hierarchy_cache_path(self) -> Path:
+        return self.cache_dir / "hierarchy.pkl"
+
+    def read_fingerprint(self, file_ids: dict[str, dict[str, os.DirEntry]]) -> bytes:
+        """Hash the name, mtime and size of every metadata/content file."""
+        entries = sorted(
+            (
+                entry
+                for exts in file_ids.values()
+                for ext, entry in exts.items()
+                if ext in ("metadata", "content")
+            ),
+            key=lambda e: e.name,
+        )
+        digest = hashlib.blake2b(digest_size=16)
+        for entry in entries:
+            stat = entry.stat()
+            digest.update(f"{entry.name}:{stat.st_mtime_ns}:{stat.st_size};".encode())
+        return digest.digest()
+
+    def load_hierarchy_cache(self, fingerprint: bytes) -> dict[str, dict] | None:
+        try:
+            with open(self.hierarchy_cache_path, "rb") as f:
+                cached = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable hierarchy cache: {e}")
+            return None
+
+        if (
+            cached.get("version") != HIERARCHY_CACHE_VERSION
+            or cached.get("fingerprint") != fingerprint
+        ):
+            return None
+        return cached["metadata"]
+
+    def save_hierarchy_cache(self, fingerprint: bytes, metadata: dict[str, dict]):
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            with open(self.hierarchy_cache_path, "wb") as f:
+                pickle.dump(
+                    {
+                        "version": HIERARCHY_CACHE_VERSION,
+                        "fingerprint": fingerprint,
+                        "metadata": metadata,
+                    },
+                    f,
+                    protocol=5,
+                )
+        except OSError as e:
+            logger.warning(f"Failed to write hierarchy cache: {e}")
+
+    def read_node_metadata(
+        self, file_id: str, entries: dict[str, os.DirEntry]
+    ) -> dict:
+        """The merged .metadata and .content of one node, read from its scanned entries."""
+        metadata = load_json(entries["metadata"].path) if "metadata" in entries else {}
+        if not metadata:
+            logger.warning(f"Metadata for {file_id} not found")
+        if "content" in entries:
+            metadata |= load_json(entries["content"].path)
+        return metadata
+
+    def read_all_metadata(
+        self, file_ids: dict[str, dict[str, os.DirEntry]]
+    ) -> dict[str, dict]:
+        ids = list(file_ids)
+        # Reads are I/O bound, so overlap them with one task per node
+        with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as ex:
+            return dict(
+                zip(
+                    ids,
+                    ex.map(
+                        self.read_node_metadata, ids, (file_ids[i] for i in ids)
+                    ),
+                )
+            )
 
-            content = self.get_content(file_id)
-            metadata |= content
+    def parse_hierarchy(self, file_ids):
+        # Only the merged JSON is cached: File objects are cheap to rebuild and
+        # read their .rm pages from disk, so they never go stale
+        fingerprint = self.read_fingerprint(file_ids)
+        all_metadata = self.load_hierarchy_cache(fingerprint)
+        if all_metadata is None or all_metadata.keys() != file_ids.keys():
+            all_metadata = self.read_all_metadata(file_ids)
+            self.save_hierarchy_cache(fingerprint, all_metadata)
+
+        for file_id, metadata in all_metadata.items():
             self.add_node(file_id, metadata)
 
         self.build_hierarchy()
+        self.prune_blocks_cache()
         return self
 
-    def read_file_ids(self):
-        file_ids = set()
-        for file in self.source_dir.glob("*"):
-            file_id = file.name.split(".")[0]
-            if not file_id or file_id.startswith("."):
-                continue
-            file_ids.add(file_id)
+    def prune_blocks_cache(self):
+        """Remove the pickled pages of documents that are gone or deleted."""
+        try:
+            with os.scandir(self.root.blocks_cache_dir) as it:
+                stale = [entry.path for entry in it if entry.name not in self.nodes]
+        except FileNotFoundError:
+            return
+        for path in stale:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def read_file_ids(self) -> dict[str, dict[str, os.DirEntry]]:
+        """Map each file id to its directory entries, keyed by extension."""
+        file_ids = {}
+        with os.scandir(self.source_dir) as it:
+            for entry in it:
+                name = entry.name
+                if not name or name[0] == ".":
+                    continue
+                file_id, _, ext = name.partition(".")
+                file_ids.setdefault(file_id, {})[ext] = entry
         return file_ids
 
 
-@dataclass
+@dataclass(slots=True)
 class Highlight:
     page_index: int
     block_index: int | float
-    tags: set[str]
+    tags: set[str] | frozenset[str]
 
 
-@dataclass
+@dataclass(slots=True)
 class TextHighlight(Highlight):
     text: str
     color: tuple[int, int, int, int]
 
 
-@dataclass
+@dataclass(slots=True)
 class ImageHighlight(Highlight):
     image_path: str
 
@@ -25,9 +25,6 @@ def convert_file(
     ),
     enable_cropping: bool = typer.Option(default=True, help="Enable cropping"),
 ):
-    with open(source_file, "rb") as f:
-        blocks = list(read_blocks(f))
-
     if output_format is None:
         output_format = source_file.suffix.removeprefix(".").lower()
     else:
@@ -41,7 +38,13 @@ def convert_file(
         "svg",
     ), f"output format {output_format} is not supported"
 
-    highlights = extract_highlights_from_blocks(blocks, enable_cropping=enable_cropping)
+    with open(source_file, "rb") as f:
+        # The blocks are read lazily, so consume them before the file is closed
+        highlights = list(
+            extract_highlights_from_blocks(
+                read_blocks(f), enable_cropping=enable_cropping
+            )
+        )
     if output_format == "md":
         if output_static_folder is None:
             output_static_folder = output_file.parent
@@ -1,15 +1,14 @@
-import glob
 import logging
 import os
 import re
 import shutil
 from dataclasses import dataclass
 from datetime import datetime
-from itertools import groupby
+from functools import lru_cache
 from pathlib import Path
-from typing import Callable
+from typing import Callable, Iterable, Iterator
 
-from jinja2 import Template
+from jinja2 import Environment, FileSystemLoader
 from rich.console import Console
 from rich.tree import Tree
 
@@ -21,11 +20,35 @@ from rmrf.base import (
     TextHighlight,
 )
 from rmrf.export.base import Writer
-from rmrf.utils import find_zotero_item
+from rmrf.utils import find_zotero_item, find_zotero_items
 
 console = Console()
 logger = logging.getLogger("rmrf")
 
+_HEADER_SIZE = 2048
+_UPDATED = b"updated: "
+_TIMESTAMP_SIZE = len("2024-01-01 00:00:00:000000")
+_DATE_FMT = "%Y-%m-%d %H:%M:%S:%f"
+_TIMESTAMP_RE = re.compile(rb"\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}:\d{6}")
+_UPDATED_RE = re.compile(rb"updated: (\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}:\d{6})")
+
+
+@lru_cache(maxsize=None)
+def get_template_environment(template_dir: str) -> Environment:
+    """One Jinja environment per template directory, so each template is compiled once per process."""
+    return Environment(loader=FileSystemLoader(template_dir), autoescape=False)
+
+
+def write_note(path: str, note: str):
+    """Write an already rendered note with a single encode and as few syscalls as possible."""
+    data = memoryview(note.encode("utf-8"))
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        while data:
+            data = data[os.write(fd, data) :]
+    finally:
+        os.close(fd)
+
 
 @dataclass
 class MarkdownWriter(Writer):
@@ -48,78 +71,113 @@ class MarkdownWriter(Writer):
 
     def __post_init__(self):
         super().__post_init__()
-        self.template = Template(Path(self.template).read_text())
+        template_path = Path(self.template).resolve()
+        self.template = get_template_environment(
+            str(template_path.parent)
+        ).get_template(template_path.name)
         self.enable_zotero = self.enable_zotero
         self.enable_cropping = self.enable_cropping
-
-    def should_update(self, node: File, force: bool = False) -> bool:
-        if force:
+        # zids of the notes already in the target dir, kept in sync by update()
+        self.existing_notes: set[str] = set()
+        try:
+            with os.scandir(self.target_dir) as it:
+                for entry in it:
+                    if entry.name.endswith(".md"):
+                        self.existing_notes.add(entry.name[:-3])
+        except FileNotFoundError:
+            pass
+
+    def note_path(self, node: File) -> str:
+        return f"{self.target_dir}/{node.zid}.md"
+
+    def should_update(
+        self, node: File, force: bool = False, md_path: str | None = None
+    ) -> bool:
+        if force or node.zid not in self.existing_notes:
             return True
 
-        if not os.path.exists(f"{self.target_dir}/{node.zid}.md"):
-            return True
+        if md_path is None:
+            md_path = self.note_path(node)
 
-        with open(f"{self.target_dir}/{node.zid}.md", "r") as f:
-            old_content = f.read()
-            last_modified = re.search(
-                r"updated: (\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}:\d{6})", old_content
-            )
-            if not last_modified:
-                return True
-            last_modified_dt = datetime.strptime(
-                last_modified.group(1), "%Y-%m-%d %H:%M:%S:%f"
-            )
-            if last_modified_dt >= datetime.strptime(
-                node.last_modified_time, "%Y-%m-%d %H:%M:%S:%f"
-            ):
-                return False
+        try:
+            f = open(md_path, "rb")
+        except FileNotFoundError:
+            return True
 
-        return True
+        with f:
+            # The front matter sits at the top, so the header is usually enough
+            head = f.read(_HEADER_SIZE)
+            start = head.find(_UPDATED) + len(_UPDATED)
+            last_modified = head[start : start + _TIMESTAMP_SIZE]
+            if start < len(_UPDATED) or not _TIMESTAMP_RE.fullmatch(last_modified):
+                match = _UPDATED_RE.search(head + f.read())
+                if not match:
+                    return True
+                last_modified = match.group(1)
+
+        # Both sides are zero-padded "%Y-%m-%d %H:%M:%S:%f", which sorts as text
+        return last_modified.decode() < node.last_modified_time
+
+    def prefetch_zotero(self, nodes: Iterable[File], force=False):
+        """Look up the Zotero items of all notes `update` would rewrite, as one concurrent batch."""
+        if not self.enable_zotero:
+            return
+        titles = [
+            self.title_getter(node)
+            for node in nodes
+            if node.rm_paths and self.should_update(node, force)
+        ]
+        if titles:
+            # The results are cached, so the lookups in update() no longer wait on the API
+            find_zotero_items(titles)
 
     def update(
         self,
         node: File,
         force=False,
-        highlights: list[Highlight] | None = None,
+        highlights: Iterable[Highlight] | None = None,
     ):
+        md_path = self.note_path(node)
         # * Read the old content if the file exists and check the dates
-        if not self.should_update(node, force):
+        if not self.should_update(node, force, md_path):
             return False, None, None
 
         pages = []
         static_dir = self.static_dir / node.zid
 
-        if static_dir.exists():
-            # remove all files in the static dir
-            for f in glob.glob(f"{static_dir}/*"):
-                os.remove(f)
+        # Start from an empty static dir; it is only re-created for image highlights
+        shutil.rmtree(static_dir, ignore_errors=True)
+        static_dir_ready = False
+        moved_images: set[str] = set()
 
-        if os.path.exists(f"{self.target_dir}/{node.zid}.md"):
-            os.remove(f"{self.target_dir}/{node.zid}.md")
+        # Bucket by page in one pass instead of sorting every highlight
+        buckets: dict[int | None, list[Highlight]] = {}
+        page_tags: dict[int | None, set[str]] = {}
+        for highlight in highlights:
+            buckets.setdefault(highlight.page_index, []).append(highlight)
+            if highlight.tags:
+                page_tags.setdefault(highlight.page_index, set()).update(highlight.tags)
 
-        for page_index, group in groupby(
-            sorted(highlights, key=lambda x: x.page_index),
-            key=lambda x: x.page_index,
-        ):
+        for page_index in sorted(buckets, key=lambda k: -1 if k is None else k):
+            group = buckets[page_index]
             highlights = []
 
             for highlight in group:
-                if isinstance(highlight, ImageHighlight):
+                # DrawingHighlight is an alias of ImageHighlight, so exact type checks suffice
+                if highlight.__class__ is ImageHighlight:
                     base_name = os.path.basename(highlight.image_path)
-                    os.makedirs(static_dir, exist_ok=True)
-                    shutil.copy(
-                        highlight.image_path,
-                        static_dir / base_name,
-                    )
-                    assert os.path.exists(
-                        static_dir / base_name
-                    ), f"static file {static_dir / base_name} does not exist"
+                    if not static_dir_ready:
+                        static_dir.mkdir(parents=True, exist_ok=True)
+                        static_dir_ready = True
+                    # identical crops on a page share one file, which is only moved once
+                    if highlight.image_path not in moved_images:
+                        # a rename when the cache and static dirs share a filesystem
+                        shutil.move(highlight.image_path, static_dir / base_name)
+                        moved_images.add(highlight.image_path)
                     highlights.append(
                         f"![Image (page {page_index})](statics/{os.path.join(node.zid, base_name)})"
                     )
-                    # remove the image file
-                    os.remove(highlight.image_path)
-                elif isinstance(highlight, TextHighlight):
+                elif highlight.__class__ is TextHighlight:
                     highlights.append(
                         # self.highlight_template.format(
                         #     text=highlight.text,
@@ -131,18 +189,15 @@ class MarkdownWriter(Writer):
                         (*highlight.color, highlight.text)
                     )
 
-            if highlight.tags:
-                tags = highlight.tags
-            else:
-                tags = []
-
-            pages.append((page_index, tags, highlights))
+            pages.append((page_index, page_tags.get(page_index, []), highlights))
 
         try:
+            modified = datetime.now().strftime(_DATE_FMT)
             original_title = self.title_getter(node)
             title = original_title.replace('"', " ").replace("'", " ")
 
-            if self.enable_zotero:
+            zotero_fields = {}
+            if self.enable_zotero and pages:
                 logger.info(
                     f"Looking up Zotero item for [yellow]{original_title}[/yellow]",
                     extra={"markup": True},
@@ -153,47 +208,50 @@ class MarkdownWriter(Writer):
                         f"Found Zotero item for [yellow]{original_title}[/yellow]",
                         extra={"markup": True},
                     )
-                    note = self.template.render(
-                        original_title=original_title,
-                        title=title,
-                        alias=title,
-                        created=node.created_time,
-                        updated=node.last_modified_time,
-                        modified=datetime.now().strftime("%Y-%m-%d %H:%M:%S:%f"),
-                        pages=pages,
-                        authors=zotero_item.authors,
-                        url=zotero_item.url,
-                        zotero_url=zotero_item.zotero_url,
-                        abstract=zotero_item.abstract,
-                    )
-                    if pages:
-                        with open(f"{self.target_dir}/{node.zid}.md", "w") as f:
-                            f.write(note)
-                        return True, None, node.last_modified_time
-
-            note = self.template.render(
-                original_title=original_title,
-                title=title,
-                alias=title,
-                created=node.created_time,
-                updated=node.last_modified_time,
-                modified=datetime.now().strftime("%Y-%m-%d %H:%M:%S:%f"),
-                pages=pages,
-            )
+                    zotero_fields = {
+                        "authors": zotero_item.authors,
+                        "url": zotero_item.url,
+                        "zotero_url": zotero_item.zotero_url,
+                        "abstract": zotero_item.abstract,
+                    }
+
             if pages:
-                with open(f"{self.target_dir}/{node.zid}.md", "w") as f:
-                    f.write(note)
+                note = self.template.render(
+                    original_title=original_title,
+                    title=title,
+                    alias=title,
+                    created=node.created_time,
+                    updated=node.last_modified_time,
+                    modified=modified,
+                    pages=pages,
+                    **zotero_fields,
+                )
+                write_note(md_path, note)
+                self.existing_notes.add(node.zid)
                 return True, None, node.last_modified_time
 
         except Exception as e:
             logger.error(f"[red]{e}[/red]", extra={"markup": True})
             raise e
         finally:
-            for f in self.cache_dir.glob("*.png"):
-                try:
-                    os.remove(f)
-                except Exception as e:
-                    logger.error(f"[red]{e}[/red]", extra={"markup": True})
+            try:
+                with os.scandir(self.cache_dir) as it:
+                    for entry in it:
+                        if not entry.name.endswith(".png"):
+                            continue
+                        try:
+                            os.unlink(entry.path)
+                        except Exception as e:
+                            logger.error(f"[red]{e}[/red]", extra={"markup": True})
+            except FileNotFoundError:
+                pass
+
+        # Nothing to write, so drop the stale note; a written note simply truncates it
+        try:
+            os.unlink(md_path)
+        except FileNotFoundError:
+            pass
+        self.existing_notes.discard(node.zid)
 
         return False, None, node.last_modified_time
 
@@ -227,56 +285,81 @@ def update(
     prefix,
     writer: MarkdownWriter,
     force=False,
-    highlight_extractor: Callable[[File], list[Highlight]] | None = None,
+    highlight_extractor: Callable[[File], Iterable[Highlight]] | None = None,
 ):
+    prefix_parts = [part for part in prefix.split("/") if part]
+    writer.prefetch_zotero(iter_notes(fs.root, prefix_parts), force=force)
+
     tree_node = Tree("/")
     update_notes(
         fs=fs,
-        prefix=prefix,
+        prefix_parts=prefix_parts,
         writer=writer,
         force=force,
         node=fs.root,
         tree_node=tree_node,
-        path="/Root",
+        depth=0,
         highlight_extractor=highlight_extractor,
     )
 
     console.print(list(tree_node.children)[0])
 
 
+def iter_notes(node: File, prefix_parts: list[str]) -> Iterator[File]:
+    """The nodes under the prefix that update_notes exports, in the same order."""
+    num_parts = len(prefix_parts)
+    stack = [(node, 0)]
+    while stack:
+        node, depth = stack.pop()
+        if depth < num_parts and node.name != prefix_parts[depth]:
+            continue
+        if depth + 1 >= num_parts:
+            yield node
+        for child in reversed(node.children):
+            stack.append((child, depth + 1))
+
+
 def update_notes(
     fs: FileSystem,
     *,
-    prefix,
+    prefix_parts: list[str],
     writer: MarkdownWriter,
     node,
     tree_node,
-    path="",
-    highlight_extractor: Callable[[File], list[Highlight]] | None = None,
+    depth=0,
+    highlight_extractor: Callable[[File], Iterable[Highlight]] | None = None,
     force=False,
 ):
-    if path.startswith(prefix):
-        updated, prev_last_modified, new_last_modified = writer.update(
-            node, force=force, highlights=highlight_extractor(node)
-        )
-        if updated and prev_last_modified != new_last_modified:
-            branch = tree_node.add(f"{node.name} [green]✓[/green]")
+    """
+    Export `node` and its descendants that fall under the prefix.
+
+    `depth` is the index of `node` in its path (the root is 0); every
+    ancestor has already matched the corresponding prefix component.
+
+    The tree is walked with an explicit stack, so deep collections do not
+    run into the recursion limit. Writes stay sequential because every
+    `writer.update` clears the shared cache dir when it is done.
+    """
+    num_parts = len(prefix_parts)
+    stack = [(node, tree_node, depth)]
+    while stack:
+        node, tree_node, depth = stack.pop()
+
+        if depth < num_parts and node.name != prefix_parts[depth]:
+            tree_node.add(f"{node.name} [red]✗[/red]")
+            continue
+
+        if depth + 1 >= num_parts:
+            updated, prev_last_modified, new_last_modified = writer.update(
+                node, force=force, highlights=highlight_extractor(node)
+            )
+            if updated and prev_last_modified != new_last_modified:
+                branch = tree_node.add(f"{node.name} [green]✓[/green]")
+            else:
+                branch = tree_node.add(f"{node.name} [yellow]〰[/yellow]")
         else:
-            branch = tree_node.add(f"{node.name} [yellow]〰[/yellow]")
-    else:
-        branch = tree_node.add(f"{node.name} [red]✗[/red]")
-
-    if not path.startswith(prefix) and not prefix.startswith(path):
-        return
-
-    for child in node.children:
-        update_notes(
-            fs=fs,
-            prefix=prefix,
-            writer=writer,
-            node=child,
-            tree_node=branch,
-            path=path + "/" + child.name,
-            force=force,
-            highlight_extractor=highlight_extractor,
-        )
+            branch = tree_node.add(f"{node.name} [red]✗[/red]")
+
+        # Pushed in reverse so children are visited, and listed, in order
+        for child in reversed(node.children):
+            stack.append((child, branch, depth + 1))
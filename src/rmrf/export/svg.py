@@ -10,10 +10,10 @@ import io
 import logging
 import math
 import string
-import xml.dom.minidom
 from dataclasses import dataclass
 from io import StringIO
 from typing import Iterable
+from xml.sax.saxutils import escape
 
 from PIL import Image
 from rmscene import (
@@ -43,6 +43,47 @@ SVG_HEADER = string.Template("""<?xml version="1.0" encoding="UTF-8"?>
 <svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" height="$height" width="$width">
 """)
 
+# Decimals kept per coordinate; 0.01px is well below what the screen resolves
+COORD_PRECISION = 2
+# A single C-level format per point is cheaper than an f-string in the stroke loop
+POINT_FORMAT = f"%.{COORD_PRECISION}f,%.{COORD_PRECISION}f "
+
+# CSS class of each paragraph style, instead of an enum construction per text item
+PARAGRAPH_STYLE_CLASSES = {style: style.name.lower() for style in ParagraphStyle}
+# Symbols drawn before list items, keyed by the style of the preceding item
+LIST_SYMBOLS = {
+    ParagraphStyle.BULLET: "•",
+    ParagraphStyle.BULLET2: "•",
+    ParagraphStyle.CHECKBOX: "☐",
+    ParagraphStyle.CHECKBOX_CHECKED: "☑",
+}
+
+# Emitted once per SVG that contains typed text
+TEXT_STYLE = """
+<style> 
+.basic, .plain {
+    font-family: sans-serif; 
+    font-size: 40px
+}
+.heading {
+    font-family: serif; 
+    font-size: 50px
+}
+.bold {
+    font-family: sans-serif; 
+    font-size: 50px
+    font-weight: bold
+}
+.bullet, .bullet2 {
+    font-family: sans-serif; 
+    font-size: 40px
+}
+.checkbox, .checkbox-checked {
+    font-family: sans-serif; 
+    font-size: 40px
+}
+</style>"""
+
 
 def blocks_to_svg(
     blocks: Iterable[tuple[Block, tuple[int, int, int, int]]],
@@ -56,8 +97,15 @@ def blocks_to_svg(
     x_scale: float = 1.0,
     y_scale: float = 1.0,
 ):
-    blocks = list(blocks)
-    output_text = ""
+    # * Strokes without points draw nothing, so they are dropped once up front
+    blocks = [
+        (block, color)
+        for block, color in blocks
+        if not isinstance(block, SceneLineItemBlock)
+        or (block.item.value is not None and block.item.value.points)
+    ]
+    # Fragments are collected and joined once instead of growing one string
+    parts: list[str] = []
 
     svg_doc_info = get_dimensions(
         [block for block, _ in blocks],
@@ -67,31 +115,41 @@ def blocks_to_svg(
         screen_height=screen_height,
     )
 
-    output_text += SVG_HEADER.substitute(
-        height=svg_doc_info.height, width=svg_doc_info.width
+    parts.append(
+        SVG_HEADER.substitute(height=svg_doc_info.height, width=svg_doc_info.width)
     )
 
     if base_image is not None:
         buffered = io.BytesIO()
         base_image.save(buffered, format="PNG")
         img_str = base64.b64encode(buffered.getvalue()).decode("utf-8")
-        output_text += f'<image xlink:href="data:image/png;base64,{img_str}" x="{margin}" y="{margin}" width="{svg_doc_info.width - margin * 2}" height="{svg_doc_info.height - margin * 2}" />'
+        parts.append(f'<image xlink:href="data:image/png;base64,{img_str}" x="{margin}" y="{margin}" width="{svg_doc_info.width - margin * 2}" height="{svg_doc_info.height - margin * 2}" />')
 
-    output_text += '<g id="p1" style="display:inline">'
-    output_text += '<filter id="blurMe"><feGaussianBlur in="SourceGraphic" stdDeviation="10" /></filter>'
+    parts.append('<g id="p1" style="display:inline">')
+    parts.append(
+        '<filter id="blurMe"><feGaussianBlur in="SourceGraphic" stdDeviation="10" /></filter>'
+    )
 
+    text_style_written = False
     for block, color in blocks:
         if isinstance(block, SceneLineItemBlock):
-            output_text += draw_stroke(block, svg_doc_info, color, x_scale, y_scale)
+            parts.append(draw_stroke(block, svg_doc_info, color, x_scale, y_scale))
         elif isinstance(block, RootTextBlock):
-            output_text += draw_text(block, svg_doc_info, x_scale, y_scale)
+            if not text_style_written:
+                parts.append(TEXT_STYLE)
+                text_style_written = True
+            parts.append(draw_text(block, svg_doc_info, x_scale, y_scale))
         else:
             logger.warning(f"not converting block: {block.__class__}")
 
-    output_text += "<!-- clickable rect to flip pages -->"
-    output_text += f'<rect x="0" y="0" width="{svg_doc_info.width}" height="{svg_doc_info.height}" fill-opacity="0"/>'
-    output_text += "</g> </svg>"
-    output.write(xml.dom.minidom.parseString(output_text).toprettyxml())
+    parts.append("<!-- clickable rect to flip pages -->")
+    parts.append(
+        f'<rect x="0" y="0" width="{svg_doc_info.width}" height="{svg_doc_info.height}" fill-opacity="0"/>'
+    )
+    parts.append("</g> </svg>")
+    # One element per line; re-parsing the document with minidom just to indent it was
+    # the slowest step for pages with many strokes
+    output.write("\n".join(parts))
 
 
 def draw_stroke(
@@ -101,12 +159,12 @@ def draw_stroke(
     x_scale: float = 1.0,
     y_scale: float = 1.0,
 ) -> str:
-    output_text = ""
-    output_text += f"<!-- SceneLineItemBlock item_id: {block.item.item_id} -->"
+    parts: list[str] = []
+    parts.append(f"<!-- SceneLineItemBlock item_id: {block.item.item_id} -->")
 
     if block.item.value is None:
         logger.debug("empty stroke")
-        return
+        return ""
 
     pen = Pen.create(
         pen_nr=block.item.value.tool.value,
@@ -114,27 +172,47 @@ def draw_stroke(
         width=block.item.value.thickness_scale,
     )
 
-    output_text += f"<!-- Stroke tool: {block.item.value.tool.name} color: {block.item.value.color.name} thickness_scale: {block.item.value.thickness_scale} -->"
-    output_text += "<polyline "
-    output_text += f'style="fill:none;stroke:rgb({pen.stroke_color[0]}, {pen.stroke_color[1]}, {pen.stroke_color[2]});stroke-width:{pen.stroke_width};opacity:{pen.stroke_opacity}" '
-    output_text += f'stroke-linecap="{pen.stroke_linecap}" '
-    output_text += 'points="'
+    parts.append(f"<!-- Stroke tool: {block.item.value.tool.name} color: {block.item.value.color.name} thickness_scale: {block.item.value.thickness_scale} -->")
+    parts.append("<polyline ")
+    parts.append(f'style="fill:none;stroke:{pen.stroke_color_rgb};stroke-width:{pen.stroke_width};opacity:{pen.stroke_opacity}" ')
+    parts.append(f'stroke-linecap="{pen.stroke_linecap}" ')
+    parts.append('points="')
 
     last_xpos = -1.0
     last_ypos = -1.0
     last_segment_width = 0
 
-    for point_id, point in enumerate(block.item.value.points):
-        xpos = (point.x + svg_doc_info.xpos_delta) * x_scale
-        ypos = (point.y + svg_doc_info.ypos_delta) * y_scale
+    # * Loop invariants are bound to locals instead of looked up per point
+    append = parts.append
+    xpos_delta = svg_doc_info.xpos_delta
+    ypos_delta = svg_doc_info.ypos_delta
+    width = svg_doc_info.width
+    height = svg_doc_info.height
+    points = block.item.value.points
+    # * Pens with a constant width and opacity draw the stroke as one segment
+    segment_length = pen.segment_length if pen.is_segment_varying else len(points)
+    # * Only the width and opacity change between segments of a stroke
+    segment_start = (
+        '"/><polyline '
+        f'style="fill:none; stroke:{pen.stroke_color_rgb};stroke-width:%.3f;opacity:%s" '
+        f'stroke-linecap="{pen.stroke_linecap}" '
+        'points="'
+    )
+
+    if __debug__ and points:
+        # * The transform is monotonic, so checking the stroke's bounding box covers every point
+        xmin, xmax, ymin, ymax = get_limits((block,))
         assert (
-            0 <= xpos <= svg_doc_info.width
-        ), f"xpos: {xpos} width: {svg_doc_info.width}"
+            0 <= (xmin + xpos_delta) * x_scale and (xmax + xpos_delta) * x_scale <= width
+        ), f"xpos: [{(xmin + xpos_delta) * x_scale}, {(xmax + xpos_delta) * x_scale}] width: {width}"
         assert (
-            0 <= ypos <= svg_doc_info.height
-        ), f"ypos: {ypos} height: {svg_doc_info.height} {point.y=}, {svg_doc_info.ypos_delta=}, {y_scale=}"
+            0 <= (ymin + ypos_delta) * y_scale and (ymax + ypos_delta) * y_scale <= height
+        ), f"ypos: [{(ymin + ypos_delta) * y_scale}, {(ymax + ypos_delta) * y_scale}] height: {height} {ypos_delta=}, {y_scale=}"
 
-        if point_id % pen.segment_length == 0:
+    for point_id, point in enumerate(points):
+        xpos = (point.x + xpos_delta) * x_scale
+        ypos = (point.y + ypos_delta) * y_scale
+        if point_id % segment_length == 0:
             segment_width = pen.get_segment_width(
                 point.speed,
                 point.direction,
@@ -149,21 +227,17 @@ def draw_stroke(
                 point.pressure,
                 last_segment_width,
             )
-            output_text += '"/>'
-            output_text += "<polyline "
-            output_text += f'style="fill:none; stroke:rgb({pen.stroke_color[0]}, {pen.stroke_color[1]}, {pen.stroke_color[2]});stroke-width:{segment_width:.3f};opacity:{segment_opacity}" '
-            output_text += f'stroke-linecap="{pen.stroke_linecap}" '
-            output_text += 'points="'
+            append(segment_start % (segment_width, segment_opacity))
             if last_xpos != -1.0:
-                output_text += f"{last_xpos:.3f},{last_ypos:.3f} "
+                append(POINT_FORMAT % (last_xpos, last_ypos))
 
         last_xpos = xpos
         last_ypos = ypos
         last_segment_width = segment_width
 
-        output_text += f"{xpos:.3f},{ypos:.3f} "
-    output_text += '"/>'
-    return output_text
+        append(POINT_FORMAT % (xpos, ypos))
+    parts.append('"/>')
+    return "".join(parts)
 
 
 def draw_text(
@@ -172,63 +246,30 @@ def draw_text(
     x_scale: float = 1.0,
     y_scale: float = 1.0,
 ) -> str:
-    output_text = ""
+    parts: list[str] = []
     logger.debug("----RootTextBlock")
-    output_text += f"<!-- RootTextBlock item_id: {block.block_id} -->"
-    output_text += """
-<style> 
-.basic, .plain {
-    font-family: sans-serif; 
-    font-size: 40px
-}
-.heading {
-    font-family: serif; 
-    font-size: 50px
-}
-.bold {
-    font-family: sans-serif; 
-    font-size: 50px
-    font-weight: bold
-}
-.bullet, .bullet2 {
-    font-family: sans-serif; 
-    font-size: 40px
-}
-.checkbox, .checkbox-checked {
-    font-family: sans-serif; 
-    font-size: 40px
-}
-</style>"""
+    parts.append(f"<!-- RootTextBlock item_id: {block.block_id} -->")
 
-    content = ""
+    content: list[str] = []
     xpos = (block.value.pos_x + svg_doc_info.xpos_delta) * x_scale
     ypos = (block.value.pos_y + svg_doc_info.ypos_delta) * y_scale
 
     newlines = 0
     py = None
+    styles = block.value.styles
     # A block of text can have multiple lines with different styles
     for text_item in block.value.items.sequence_items():
-        self_style = block.value.styles.get(text_item.item_id, None)
-        left_style = block.value.styles.get(text_item.left_id, None)
+        self_style = styles.get(text_item.item_id, None)
+        left_style = styles.get(text_item.left_id, None)
 
         style_class = "plain"
         if self_style is not None:
-            style_class = ParagraphStyle(self_style.value).name.lower()
+            style_class = PARAGRAPH_STYLE_CLASSES[self_style.value]
 
         margin = 0
-        if left_style is not None and left_style.value in [
-            ParagraphStyle.BULLET,
-            ParagraphStyle.BULLET2,
-            ParagraphStyle.CHECKBOX,
-            ParagraphStyle.CHECKBOX_CHECKED,
-        ]:
-            symbol = {
-                ParagraphStyle.BULLET: "•",
-                ParagraphStyle.BULLET2: "•",
-                ParagraphStyle.CHECKBOX: "☐",
-                ParagraphStyle.CHECKBOX_CHECKED: "☑",
-            }[left_style.value]
-            content += f"<tspan x='{xpos}' dy='{newlines/2}em' class='{style_class}'>{symbol}</tspan>"
+        symbol = LIST_SYMBOLS.get(left_style.value) if left_style is not None else None
+        if symbol is not None:
+            content.append(f"<tspan x='{xpos}' dy='{newlines/2}em' class='{style_class}'>{symbol}</tspan>")
             margin = 50
 
         started = False
@@ -250,18 +291,18 @@ def draw_text(
 
             if not started:
                 started = True
-                content += f"<tspan x='{xpos + margin}' dy='{delta}em' class='{style_class}' part_index='{i}'>{part}</tspan>"
+                content.append(f"<tspan x='{xpos + margin}' dy='{delta}em' class='{style_class}' part_index='{i}'>{escape(part)}</tspan>")
             else:
                 newlines += 1
-                content += f"<tspan x='{xpos + margin}' dy='{delta}em' class='{style_class}' part_index='{i}'>{part}</tspan>"
+                content.append(f"<tspan x='{xpos + margin}' dy='{delta}em' class='{style_class}' part_index='{i}'>{escape(part)}</tspan>")
 
         newlines += 1
 
-    output_text += f"<!-- RootTextBlock item_id: {block.block_id} -->"
+    parts.append(f"<!-- RootTextBlock item_id: {block.block_id} -->")
     if content:
-        output_text += f"""<text x="{xpos}" y="{ypos}">{content}</text>"""
+        parts.append(f'<text x="{xpos}" y="{ypos}">{"".join(content)}</text>')
 
-    return output_text
+    return "".join(parts)
 
 
 def get_limits(blocks: Iterable[Block]) -> tuple[float, float, float, float]:
@@ -273,16 +314,21 @@ def get_limits(blocks: Iterable[Block]) -> tuple[float, float, float, float]:
         if not isinstance(block, SceneLineItemBlock):
             continue
 
-        if block.item.value is None:
+        if block.item.value is None or not block.item.value.points:
             continue
 
+        # Plain comparisons instead of four min/max calls per point
         for point in block.item.value.points:
             xpos = point.x
             ypos = point.y
-            xmin = min(xmin, xpos)
-            xmax = max(xmax, xpos)
-            ymin = min(ymin, ypos)
-            ymax = max(ymax, ypos)
+            if xpos < xmin:
+                xmin = xpos
+            if xpos > xmax:
+                xmax = xpos
+            if ypos < ymin:
+                ymin = ypos
+            if ypos > ymax:
+                ymax = ypos
 
     return xmin, xmax, ymin, ymax
 
@@ -1,6 +1,11 @@
+import io
 import logging
 import math
-from tempfile import NamedTemporaryFile
+import os
+import secrets
+from itertools import count
+from operator import itemgetter
+from typing import Iterable, Iterator
 
 import fitz
 from PIL import Image
@@ -11,15 +16,62 @@ from rmscene import (
     SceneLineItemBlock,
     UnreadableBlock,
 )
-from shapely.geometry import Polygon
 
 from rmrf.base import DrawingHighlight, File, Highlight, ImageHighlight, TextHighlight
 from rmrf.export import blocks_to_svg
-from rmrf.utils import remarkable_palette
+from rmrf.utils import remarkable_palette_rgba
 
 console = Console()
 warned_about_transformation = False
 logger = logging.getLogger("rmrf")
+# Pages are rendered at this resolution for crops and drawings; 200 keeps highlighted
+# text crisp in a note at less than half the pixels of 300
+DEFAULT_DPI = 200
+# SVGs are written in many small pieces, so buffer them into fewer write() calls
+CACHE_WRITE_BUFFER_SIZE = 512 * 1024
+
+
+def get_png_compress_level(default: int = 6) -> int:
+    """The zlib level from RMRF_PNG_COMPRESS_LEVEL, clamped to 0-9, or `default` if unset or invalid."""
+    value = os.environ.get("RMRF_PNG_COMPRESS_LEVEL")
+    if value is None:
+        return default
+    try:
+        level = int(value)
+    except ValueError:
+        logger.warning(
+            "Ignoring RMRF_PNG_COMPRESS_LEVEL=%r, expected an integer from 0 to 9", value
+        )
+        return default
+    return min(max(level, 0), 9)
+
+
+# zlib level for cropped highlights, which end up in the vault; PIL's default of 6 unless
+# RMRF_PNG_COMPRESS_LEVEL trades larger files for faster exports (e.g. 1)
+PNG_COMPRESS_LEVEL = get_png_compress_level()
+
+
+# Shared by every highlight on an untagged page
+EMPTY_TAGS: frozenset[str] = frozenset()
+
+# Kinds of blocks returned by classify_block
+IGNORED_BLOCK, HIGHLIGHT_BLOCK, HANDWRITING_BLOCK = range(3)
+# How extract_highlights_from_blocks treats a block type, see get_block_role
+SKIPPED_ROLE, UNREADABLE_ROLE, TEXT_ROLE, LINE_ROLE, GLYPH_ROLE = range(5)
+
+
+_cache_file_ids = count()
+# A pid can be reused by a later run, whose counter would then name the files a crashed
+# run left behind; the random token keeps the names of the two runs apart
+_cache_file_token = secrets.token_hex(4)
+
+
+def cache_path(cache_dir: str | os.PathLike, suffix: str) -> str:
+    """A fresh file name in the cache dir; unique per process and run, without mkstemp's retries."""
+    return os.path.join(
+        cache_dir,
+        f"rmrf_{os.getpid()}_{_cache_file_token}_{next(_cache_file_ids)}{suffix}",
+    )
 
 
 class TransformationError(Exception):
@@ -29,44 +81,135 @@ class TransformationError(Exception):
 def get_color(
     block: SceneLineItemBlock | SceneGlyphItemBlock,
 ) -> tuple[int, int, int, int]:
-    if block.extra_data and len(block.extra_data) >= 5:
-        *_, b, g, r, a = block.extra_data
-        return (r, g, b, a)
+    extra_data = block.extra_data
+    if extra_data and len(extra_data) >= 5:
+        # Trailing b, g, r, a bytes; indexed rather than star-unpacked into a list
+        return (extra_data[-2], extra_data[-3], extra_data[-4], extra_data[-1])
+
+    color = block.item.value.color
+    rgba = remarkable_palette_rgba[color] if 0 <= color < len(remarkable_palette_rgba) else None
+    if rgba is None:
+        # The same error the palette dict raised, rather than a None color further down
+        raise KeyError(color)
+    return rgba
+
+
+def get_block_limits(
+    block: SceneLineItemBlock | SceneGlyphItemBlock | RootTextBlock,
+) -> tuple[float, float, float, float] | None:
+    """Bounding box of a single block as (x_min, y_min, x_max, y_max), or None if it has no points."""
+    if isinstance(block, SceneLineItemBlock):
+        if not (block.item and block.item.value and block.item.value.points):
+            return None
+        points = block.item.value.points
+        # One pass without intermediate lists; faster than min/max over comprehensions
+        point = points[0]
+        x_min = x_max = point.x
+        y_min = y_max = point.y
+        for point in points:
+            x = point.x
+            y = point.y
+            if x < x_min:
+                x_min = x
+            elif x > x_max:
+                x_max = x
+            if y < y_min:
+                y_min = y
+            elif y > y_max:
+                y_max = y
+        return (x_min, y_min, x_max, y_max)
+
+    if isinstance(block, RootTextBlock) and block.value:
+        return (block.value.pos_x, block.value.pos_y, block.value.pos_x, block.value.pos_y)
+
+    return None
+
+
+def get_block_role(block_type: type, allowed_elements: tuple[type, ...]) -> int:
+    """Map a block type to the branch extract_highlights_from_blocks takes for it."""
+    if not issubclass(block_type, allowed_elements):
+        if issubclass(block_type, UnreadableBlock):
+            return UNREADABLE_ROLE
+        return SKIPPED_ROLE
+    if issubclass(block_type, RootTextBlock):
+        return TEXT_ROLE
+    if issubclass(block_type, SceneLineItemBlock):
+        return LINE_ROLE
+    return GLYPH_ROLE
+
+
+def classify_block(block: SceneLineItemBlock | SceneGlyphItemBlock) -> int:
+    """
+    Classify a block in a single look at its fields.
 
-    r, g, b, *a = remarkable_palette[block.item.value.color]
-    if a:
-        a = a[0]
-    else:
-        a = 255
-    return (r, g, b, a)
+    Equivalent to `File.is_highlight_block` followed by `File.is_handwriting_block`,
+    but only glyphs are checked for highlight text and only strokes for points.
+
+    Parameters
+    ----------
+    block: SceneLineItemBlock | SceneGlyphItemBlock
+        The block to classify.
+
+    Returns
+    -------
+    int
+        One of IGNORED_BLOCK, HIGHLIGHT_BLOCK or HANDWRITING_BLOCK.
+    """
+    value = block.item.value if block.item else None
+    if not value:
+        return IGNORED_BLOCK
+
+    if isinstance(block, SceneGlyphItemBlock):
+        # It must have at least 5 bytes to contain a color (a, r, g, b, ?)
+        extra_data = block.extra_data
+        if value.text and len(extra_data) >= 5 and extra_data.startswith(b"\xa4\x01"):
+            return HIGHLIGHT_BLOCK
+        return IGNORED_BLOCK
+
+    if getattr(value, "points", None):
+        return HANDWRITING_BLOCK
+    return IGNORED_BLOCK
 
 
 def get_limits(
     blocks: list[SceneLineItemBlock | SceneGlyphItemBlock | RootTextBlock],
 ) -> tuple[int | None, int | None, int | None, int | None]:
-    x_values = []
-    y_values = []
+    x_min = y_min = math.inf
+    x_max = y_max = -math.inf
     for block in blocks:
-        if (
-            isinstance(block, SceneLineItemBlock)
-            and block.item
-            and block.item.value
-            and block.item.value.points
-        ):
-            x_values.extend(p.x for p in block.item.value.points)
-            y_values.extend(p.y for p in block.item.value.points)
-        elif isinstance(block, RootTextBlock) and block.value:
-            x_values.append(block.value.pos_x)
-            y_values.append(block.value.pos_y)
-
-    if not x_values or not y_values:
+        limits = get_block_limits(block)
+        if limits is None:
+            continue
+        b_x_min, b_y_min, b_x_max, b_y_max = limits
+        if b_x_min < x_min:
+            x_min = b_x_min
+        if b_y_min < y_min:
+            y_min = b_y_min
+        if b_x_max > x_max:
+            x_max = b_x_max
+        if b_y_max > y_max:
+            y_max = b_y_max
+
+    if x_min == math.inf:
         return (None, None, None, None)
 
-    return (min(x_values), min(y_values), max(x_values), max(y_values))
+    return (x_min, y_min, x_max, y_max)
+
+
+def polygon_area(points) -> float:
+    """Area of the closed polygon through `points`, using the shoelace formula."""
+    area = 0.0
+    prev = points[-1]
+    for point in points:
+        area += prev.x * point.y - point.x * prev.y
+        prev = point
+    return abs(area) / 2
 
 
 def is_rectangular(
-    block: SceneLineItemBlock | SceneGlyphItemBlock, threshold: float = 0.8
+    block: SceneLineItemBlock | SceneGlyphItemBlock,
+    threshold: float = 0.8,
+    limits: tuple[float, float, float, float] | None = None,
 ) -> bool:
     """
     Test if the block is close to a rectangle.
@@ -77,20 +220,43 @@ def is_rectangular(
         The block to test.
     threshold: float
         The threshold for the ratio of the area of the polygon to the area of the rectangle. Defaults to 0.8.
+    limits: tuple[float, float, float, float] | None
+        The bounding box of the block, if already computed. Defaults to None.
 
     Returns
     -------
     bool
         True if the block is close to a rectangle, False otherwise.
     """
-    if len(block.item.value.points) < 4:
+    points = block.item.value.points
+    if len(points) < 4:
         return False
-    polygon = Polygon([(p.x, p.y) for p in block.item.value.points])
-    x_min, y_min, x_max, y_max = get_limits([block])
+    x_min, y_min, x_max, y_max = limits or get_block_limits(block)
     rectangle = (x_max - x_min) * (y_max - y_min)
     if rectangle <= 0:
         return False
-    return polygon.area / rectangle >= threshold
+    return polygon_area(points) / rectangle >= threshold
+
+
+def render_page(doc: fitz.Document, page_index: int, dpi: int = DEFAULT_DPI) -> Image.Image:
+    """
+    Render a full page of the document.
+
+    Each page is rendered once by `get_transformation`, and every crop on it
+    is cut from that image, so renders are not cached.
+    """
+    pixmap = doc[page_index].get_pixmap(dpi=dpi)
+    # samples_mv views the pixmap memory, where samples would copy it into bytes first;
+    # PIL still copies once into its own RGB layout, so the pixmap can be dropped after
+    return Image.frombuffer(
+        "RGB",
+        (pixmap.width, pixmap.height),
+        pixmap.samples_mv,
+        "raw",
+        "RGB",
+        pixmap.stride,
+        1,
+    )
 
 
 def get_transformation(
@@ -98,7 +264,8 @@ def get_transformation(
     blocks: list[SceneLineItemBlock | SceneGlyphItemBlock | RootTextBlock],
     doc: fitz.Document | None = None,
     page_index: int | None = None,
-    dpi: int = 300,
+    dpi: int = DEFAULT_DPI,
+    limits: tuple[float, float, float, float] | None = None,
 ) -> tuple[int, int, int, int, float, float, Image.Image | None]:
     """
     Get the transformation matrix for the blocks.
@@ -114,7 +281,9 @@ def get_transformation(
     page_index: int | None
         The page index to get the transformation for. Defaults to None.
     dpi: int
-        The DPI to use for the transformation. Defaults to 300.
+        The DPI to use for the transformation. Defaults to DEFAULT_DPI.
+    limits: tuple[float, float, float, float] | None
+        The result of `get_limits(blocks)`, if the caller already has it. Defaults to None.
 
     Returns
     -------
@@ -126,20 +295,18 @@ def get_transformation(
         logger.warning("Transformation is highly experimental")
         warned_about_transformation = True
 
-    x_min, y_min, x_max, y_max = get_limits(blocks)
+    x_min, y_min, x_max, y_max = limits if limits is not None else get_limits(blocks)
     if x_min is None or y_min is None or x_max is None or y_max is None:
         raise TransformationError("No points found in the blocks")
 
-    logger.debug(f"{x_min=:.2f}, {y_min=:.2f}, {x_max=:.2f}, {y_max=:.2f}")
+    logger.debug(
+        "x_min=%.2f, y_min=%.2f, x_max=%.2f, y_max=%.2f", x_min, y_min, x_max, y_max
+    )
 
     if doc is not None and page_index is not None:
-        page = doc[page_index]
-        image = page.get_pixmap(
-            dpi=dpi,
-        )
-        base_image = Image.frombytes("RGB", (image.width, image.height), image.samples)
-        image_width = image.width
-        image_height = image.height
+        base_image = render_page(doc, page_index, dpi)
+        image_width = base_image.width
+        image_height = base_image.height
     else:
         base_image = None
         image_width = None
@@ -150,39 +317,46 @@ def get_transformation(
     # screen_height = node.screen_height
     screen_height = node.zoom_height
 
-    logger.debug(f"{screen_width=:.2f}, {screen_height=:.2f}")
+    logger.debug("screen_width=%.2f, screen_height=%.2f", screen_width, screen_height)
 
     x_delta = screen_width / 2
     y_delta = abs(y_min) if y_min < 0 else 0
 
-    while (
+    # Growing x_delta and then screen_width to cover it satisfies every
+    # constraint in one step, so this is solved directly rather than iterated
+    if (
         x_max - x_min > screen_width
         or x_min + x_delta < 0
         or x_max + x_delta > screen_width
         or x_max > screen_width
         or x_delta * 2 > screen_width
     ):
-        c1, r1 = abs(x_min) if x_min < 0 else 0, "Offsetting negative x"
-        c2, r2 = x_delta, "x_delta"
-        c3, r3 = screen_width / 2, "Screen width / 2"
-
-        x_delta_ = max(c1, c2, c3)
+        x_delta_, reason = max(
+            (abs(x_min) if x_min < 0 else 0, "Offsetting negative x"),
+            (x_delta, "x_delta"),
+            (screen_width / 2, "Screen width / 2"),
+            key=itemgetter(0),
+        )
 
         if x_delta_ != x_delta:
-            reason = [r1, r2, r3][[c1, c2, c3].index(x_delta_)]
-            logger.warning(f"{x_delta=:.2f} -> {x_delta_=:.2f} ({reason})")
+            logger.warning("x_delta=%.2f -> x_delta_=%.2f (%s)", x_delta, x_delta_, reason)
         x_delta = x_delta_
 
-        c1, r1 = math.ceil(x_max - x_min), "x_max - x_min"
-        c2, r2 = screen_width, "screen_width"
-        c3, r3 = math.ceil(x_delta * 2), "2 * x_delta"
-        c4, r4 = math.ceil(x_max + x_delta), "x_max + x_delta"
-
-        screen_width_ = max(c1, c2, c3, c4)
+        screen_width_, reason = max(
+            (math.ceil(x_max - x_min), "x_max - x_min"),
+            (screen_width, "screen_width"),
+            (math.ceil(x_delta * 2), "2 * x_delta"),
+            (math.ceil(x_max + x_delta), "x_max + x_delta"),
+            key=itemgetter(0),
+        )
 
         if screen_width_ != screen_width:
-            reason = [r1, r2, r3, r4][[c1, c2, c3, c4].index(screen_width_)]
-            logger.warning(f"{screen_width=:.2f} -> {screen_width_=:.2f} ({reason})")
+            logger.warning(
+                "screen_width=%.2f -> screen_width_=%.2f (%s)",
+                screen_width,
+                screen_width_,
+                reason,
+            )
             screen_height = screen_height * screen_width_ / screen_width
 
         screen_width = screen_width_
@@ -195,33 +369,39 @@ def get_transformation(
         x_max - x_min <= screen_width
     ), f"{x_max=:.2f}, {x_min=:.2f}, {screen_width=:.2f}"
 
-    while (
+    # Same for the vertical axis: one update of y_delta and screen_height suffices
+    if (
         y_max - y_min > screen_height
         or y_min + y_delta < 0
         or y_max + y_delta > screen_height
         or y_max > screen_height
     ):
-        c1, r1 = abs(y_min) if y_min < 0 else 0, "Offsetting negative y"
-        c2, r2 = node.center_y - screen_height / 2, "center_y - screen_height / 2"
-        c3, r3 = y_delta, "y_delta"
-
-        y_delta_ = max(c1, c2, c3)
+        y_delta_, reason = max(
+            (abs(y_min) if y_min < 0 else 0, "Offsetting negative y"),
+            (node.center_y - screen_height / 2, "center_y - screen_height / 2"),
+            (y_delta, "y_delta"),
+            key=itemgetter(0),
+        )
 
         if y_delta_ != y_delta:
-            reason = [r1, r2, r3][[c1, c2, c3].index(y_delta_)]
-            logger.warning(f"{y_delta=:.2f} -> {y_delta_=:.2f} ({reason})")
+            logger.warning("y_delta=%.2f -> y_delta_=%.2f (%s)", y_delta, y_delta_, reason)
         y_delta = y_delta_
 
-        c1, r1 = math.ceil(y_max - y_min), "y_max - y_min"
-        c2, r2 = screen_height, "screen_height"
-        c3, r3 = math.ceil(y_max + y_delta), "y_max + y_delta"
-        c4, r4 = math.ceil(y_max), "y_max"
-
-        screen_height_ = max(c1, c2, c3, c4)
+        screen_height_, reason = max(
+            (math.ceil(y_max - y_min), "y_max - y_min"),
+            (screen_height, "screen_height"),
+            (math.ceil(y_max + y_delta), "y_max + y_delta"),
+            (math.ceil(y_max), "y_max"),
+            key=itemgetter(0),
+        )
 
         if screen_height_ != screen_height:
-            reason = [r1, r2, r3, r4][[c1, c2, c3, c4].index(screen_height_)]
-            logger.warning(f"{screen_height=:.2f} -> {screen_height_=:.2f} ({reason})")
+            logger.warning(
+                "screen_height=%.2f -> screen_height_=%.2f (%s)",
+                screen_height,
+                screen_height_,
+                reason,
+            )
             screen_width = max(
                 screen_width * screen_height_ / screen_height,
                 screen_width,
@@ -258,165 +438,57 @@ def get_transformation(
 def extract_highlights(
     node: File,
     enable_cropping: bool = True,
-) -> list[Highlight]:
+    dpi: int = DEFAULT_DPI,
+) -> Iterator[Highlight]:
     """
     Extract highlights from the node.
 
+    Highlights are yielded page by page, so nothing is parsed or rendered
+    until the caller starts consuming them.
+
     Parameters
     ----------
     node: Node
         The node to extract highlights from.
     enable_cropping: bool
         Whether to enable cropping. Defaults to True.
+    dpi: int
+        The DPI pages are rendered at for crops and drawings. Lower values use
+        less memory and time at the cost of image quality. Defaults to DEFAULT_DPI.
 
     Returns
     -------
-    list[Highlight]
+    Iterator[Highlight]
         The highlights extracted from the node.
     """
-    highlights: list[Highlight] = []
-    if not node.rm_blocks:
-        return highlights
+    if not node.rm_paths:
+        return
 
     doc = node.doc
-
-    for page_index, blocks in sorted(node.rm_blocks.items(), key=lambda x: x[0]):
-        highlights.extend(
-            extract_highlights_from_blocks(
-                blocks,
-                enable_cropping,
-                node=node,
-                doc=doc,
-                page_index=page_index,
-                page_tags=node.page_tags.get(page_index, set()),
-            )
+    page_tags = node.page_tags
+
+    for page_index in sorted(node.rm_paths):
+        yield from extract_highlights_from_blocks(
+            node.get_page_blocks(page_index),
+            enable_cropping,
+            node=node,
+            doc=doc,
+            page_index=page_index,
+            page_tags=page_tags.get(page_index, EMPTY_TAGS),
+            dpi=dpi,
         )
-        # svg_blocks = []
-        # cropping_blocks = []
-
-        # for block_idx, block in enumerate(blocks):
-        #     if not isinstance(block, node.valid_elements):
-        #         if isinstance(block, UnreadableBlock):
-        #             logger.error(f"{block}")
-        #         continue
-
-        #     if isinstance(block, RootTextBlock):
-        #         svg_blocks.append((block_idx, block, (0, 0, 0, 255)))
-        #         continue
-
-        #     if isinstance(block, SceneLineItemBlock) and block.item.value is None:
-        #         continue
-
-        #     if block.item.deleted_length > 0:
-        #         continue
-
-        #     # * If this is a highlight block, we don't need to draw it
-        #     if node.is_highlight_block(block):
-        #         highlights.append(
-        #             TextHighlight(
-        #                 page_index=page_index or -1,
-        #                 block_index=block_idx,
-        #                 tags=node.page_tags.get(page_index, set()),
-        #                 text=block.item.value.text,
-        #                 color=get_color(block),
-        #             )
-        #         )
-        #         continue
-
-        #     # * If this is not a handwriting block, we don't need to draw it
-        #     if not node.is_handwriting_block(block):
-        #         continue
-
-        #     # * test if the block is close to a rectangle
-        #     if is_rectangular(block) and enable_cropping:
-        #         cropping_blocks.append((block_idx, block))
-        #     else:
-        #         svg_blocks.append((block_idx, block, get_color(block)))
-
-        # try:
-        #     (
-        #         x_delta,
-        #         y_delta,
-        #         screen_width,
-        #         screen_height,
-        #         x_scale,
-        #         y_scale,
-        #         base_image,
-        #     ) = get_transformation(node, blocks, doc, page_index)
-        # except TransformationError as e:
-        #     logger.debug(f"Skipping page {page_index}: {e}")
-
-        # if cropping_blocks and base_image:
-        #     for block_idx, block in cropping_blocks:
-        #         x_min, y_min, x_max, y_max = get_limits([block])
-        #         cropped = base_image.crop(
-        #             (
-        #                 (x_min + x_delta) * x_scale,
-        #                 (y_min + y_delta) * y_scale,
-        #                 (x_max + x_delta) * x_scale,
-        #                 (y_max + y_delta) * y_scale,
-        #             )
-        #         )
-        #         with NamedTemporaryFile(
-        #             mode="wb", suffix=".png", delete=False, dir=node.cache_dir
-        #         ) as f:
-        #             cropped.save(f)
-        #             highlights.append(
-        #                 ImageHighlight(
-        #                     page_index=page_index,
-        #                     block_index=block_idx,
-        #                     tags=node.page_tags.get(page_index, set()),
-        #                     image_path=f.name,
-        #                 )
-        #             )
-
-        # elif cropping_blocks and not base_image:
-        #     svg_blocks.extend(
-        #         [
-        #             (block_idx, block, get_color(block))
-        #             for block_idx, block in cropping_blocks
-        #         ]
-        #     )
-
-        # if svg_blocks:
-        #     with NamedTemporaryFile(
-        #         mode="w", suffix=".svg", delete=False, dir=node.cache_dir
-        #     ) as f:
-        #         margin = 0
-
-        #         blocks_to_svg(
-        #             [(block, color) for _, block, color in svg_blocks],
-        #             f,
-        #             xpos_shift=x_delta + margin,
-        #             ypos_shift=y_delta + margin,
-        #             screen_width=screen_width + margin * 2,
-        #             screen_height=screen_height + margin * 2,
-        #             base_image=base_image,
-        #             margin=margin,
-        #             x_scale=x_scale,
-        #             y_scale=y_scale,
-        #         )
-
-        #         highlights.append(
-        #             DrawingHighlight(
-        #                 page_index=page_index,
-        #                 block_index=float("inf"),
-        #                 tags=node.page_tags.get(page_index, set()),
-        #                 image_path=f.name,
-        #             )
-        #         )
-
-    return highlights
+
 
 def extract_highlights_from_blocks(
-    blocks: list[SceneLineItemBlock | SceneGlyphItemBlock | RootTextBlock],
+    blocks: Iterable[SceneLineItemBlock | SceneGlyphItemBlock | RootTextBlock],
     enable_cropping: bool = True,
     allowed_elements: set| None = None,
     page_index: int | None = None,
     page_tags: set | None = None,
     node: File | None = None,
     doc: fitz.Document | None = None,
-) -> list[Highlight]:
+    dpi: int = DEFAULT_DPI,
+) -> Iterator[Highlight]:
     if allowed_elements is None:
         allowed_elements = (SceneLineItemBlock, SceneGlyphItemBlock, RootTextBlock)
 
@@ -430,51 +502,90 @@ def extract_highlights_from_blocks(
 
         node = MockNode()
 
-    highlights: list[Highlight] = []
     svg_blocks = []
     cropping_blocks = []
+    # `blocks` may be a one-shot stream, so keep only what the page layout needs
+    layout_blocks = []
+    x_min = y_min = math.inf
+    x_max = y_max = -math.inf
+    # * Bound once instead of per highlight
+    tags = page_tags or EMPTY_TAGS
+    cache_dir = node.cache_dir
+
+    # * Block types are resolved once per type instead of with isinstance chains per block
+    block_roles: dict[type, int] = {}
 
     for block_idx, block in enumerate(blocks):
-        if not isinstance(block, allowed_elements):
-            if isinstance(block, UnreadableBlock):
-                logger.error(f"{block}")
+        block_type = block.__class__
+        role = block_roles.get(block_type)
+        if role is None:
+            role = block_roles[block_type] = get_block_role(block_type, allowed_elements)
+
+        if role == SKIPPED_ROLE:
+            continue
+
+        if role == UNREADABLE_ROLE:
+            logger.error(f"{block}")
             continue
 
-        if isinstance(block, RootTextBlock):
+        block_limits = None
+        if role != GLYPH_ROLE:
+            layout_blocks.append(block)
+            # * The page bounds are accumulated here instead of another pass in get_limits
+            block_limits = get_block_limits(block)
+            if block_limits is not None:
+                b_x_min, b_y_min, b_x_max, b_y_max = block_limits
+                if b_x_min < x_min:
+                    x_min = b_x_min
+                if b_y_min < y_min:
+                    y_min = b_y_min
+                if b_x_max > x_max:
+                    x_max = b_x_max
+                if b_y_max > y_max:
+                    y_max = b_y_max
+
+        if role == TEXT_ROLE:
             svg_blocks.append((block_idx, block, (0, 0, 0, 255)))
             continue
 
-        if isinstance(block, SceneLineItemBlock) and block.item.value is None:
+        if role == LINE_ROLE and block.item.value is None:
             continue
 
         if block.item.deleted_length > 0:
             continue
 
+        kind = classify_block(block)
+
         # * If this is a highlight block, we don't need to draw it
-        if File.is_highlight_block(block):
-            highlights.append(
-                TextHighlight(
-                    page_index=page_index or -1,
-                    block_index=block_idx,
-                    tags=page_tags or set(),
-                    text=block.item.value.text,
-                    color=get_color(block),
-                )
+        if kind == HIGHLIGHT_BLOCK:
+            yield TextHighlight(
+                page_index=page_index or -1,
+                block_index=block_idx,
+                tags=tags,
+                text=block.item.value.text,
+                color=get_color(block),
             )
             continue
 
         # * If this is not a handwriting block, we don't need to draw it
-        if not File.is_handwriting_block(block):
+        if kind != HANDWRITING_BLOCK:
             continue
 
         # * test if the block is close to a rectangle
-        if is_rectangular(block) and enable_cropping:
-            cropping_blocks.append((block_idx, block))
+        if enable_cropping and is_rectangular(block, limits=block_limits):
+            cropping_blocks.append((block_idx, block, block_limits))
         else:
             svg_blocks.append((block_idx, block, get_color(block)))
 
-    try:
+    if not cropping_blocks and not svg_blocks:
+        # * Nothing to draw, so there is no need to lay out or render the page
+        return
 
+    x_delta = y_delta = 0
+    screen_width, screen_height = node.zoom_width, node.zoom_height
+    x_scale = y_scale = 1.0
+    base_image = None
+    try:
         (
             x_delta,
             y_delta,
@@ -483,46 +594,57 @@ def extract_highlights_from_blocks(
             x_scale,
             y_scale,
             base_image,
-        ) = get_transformation(node, blocks, doc, page_index)
+        ) = get_transformation(
+            node,
+            layout_blocks,
+            doc,
+            page_index,
+            dpi=dpi,
+            limits=(x_min, y_min, x_max, y_max) if x_min != math.inf else None,
+        )
     except TransformationError as e:
-        logger.debug(f"Skipping page {page_index}: {e}")
+        logger.debug("Skipping page %s: %s", page_index, e)
 
     if cropping_blocks and base_image:
-        for block_idx, block in cropping_blocks:
-            x_min, y_min, x_max, y_max = get_limits([block])
-            cropped = base_image.crop(
-                (
-                    (x_min + x_delta) * x_scale,
-                    (y_min + y_delta) * y_scale,
-                    (x_max + x_delta) * x_scale,
-                    (y_max + y_delta) * y_scale,
-                )
+        # * Boxes that land on the same pixels (e.g. a box traced twice) share one image
+        crops: dict[tuple[int, int, int, int], str] = {}
+        for block_idx, block, (x_min, y_min, x_max, y_max) in cropping_blocks:
+            # * The same rounding PIL applies in Image.crop
+            box = (
+                round((x_min + x_delta) * x_scale),
+                round((y_min + y_delta) * y_scale),
+                round((x_max + x_delta) * x_scale),
+                round((y_max + y_delta) * y_scale),
             )
-            with NamedTemporaryFile(
-                mode="wb", suffix=".png", delete=False, dir=node.cache_dir
-            ) as f:
-                cropped.save(f)
-                highlights.append(
-                    ImageHighlight(
-                        page_index=page_index,
-                        block_index=block_idx,
-                        tags=page_tags or set(),
-                        image_path=f.name,
-                    )
+            image_path = crops.get(box)
+            if image_path is None:
+                image_path = crops[box] = cache_path(cache_dir, ".png")
+                # * PIL writes PNGs chunk by chunk, so encode in memory and write once
+                buffer = io.BytesIO()
+                base_image.crop(box).save(
+                    buffer, format="PNG", compress_level=PNG_COMPRESS_LEVEL
                 )
+                with open(image_path, "wb") as f:
+                    f.write(buffer.getbuffer())
+            # * Only hand the image out once it is flushed and closed
+            yield ImageHighlight(
+                page_index=page_index,
+                block_index=block_idx,
+                tags=tags,
+                image_path=image_path,
+            )
 
     elif cropping_blocks and not base_image:
         svg_blocks.extend(
             [
                 (block_idx, block, get_color(block))
-                for block_idx, block in cropping_blocks
+                for block_idx, block, _ in cropping_blocks
             ]
         )
 
     if svg_blocks:
-        with NamedTemporaryFile(
-            mode="w", suffix=".svg", delete=False, dir=node.cache_dir
-        ) as f:
+        image_path = cache_path(cache_dir, ".svg")
+        with open(image_path, "w", buffering=CACHE_WRITE_BUFFER_SIZE) as f:
             margin = 0
 
             blocks_to_svg(
@@ -538,14 +660,9 @@ def extract_highlights_from_blocks(
                 y_scale=y_scale,
             )
 
-            highlights.append(
-                DrawingHighlight(
-                    page_index=page_index,
-                    block_index=float("inf"),
-                    tags=page_tags or set(),
-                    image_path=f.name,
-                )
-            )
-
-    return highlights
-
+        yield DrawingHighlight(
+            page_index=page_index,
+            block_index=float("inf"),
+            tags=tags,
+            image_path=image_path,
+        )
@@ -1,4 +1,10 @@
-from .writing_tools import Pen, remarkable_palette
-from .zotero_helper import find_zotero_item
+from .writing_tools import Pen, remarkable_palette, remarkable_palette_rgba
+from .zotero_helper import find_zotero_item, find_zotero_items
 
-__all__ = ["Pen", "remarkable_palette", "find_zotero_item"]
+__all__ = [
+    "Pen",
+    "remarkable_palette",
+    "remarkable_palette_rgba",
+    "find_zotero_item",
+    "find_zotero_items",
+]
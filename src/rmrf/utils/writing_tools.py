@@ -9,6 +9,7 @@
 
 import math
 from dataclasses import dataclass
+from functools import lru_cache
 
 from rmscene.scene_items import Pen as PenType
 from rmscene.scene_items import PenColor
@@ -44,6 +45,17 @@ remarkable_palette = {
     PenColor.SHADER_CYAN: (116, 210, 232, 102),
 }
 
+# the palette as RGBA tuples indexed by color value, so per-block lookups skip hashing
+remarkable_palette_rgba = tuple(
+    (*rgba[:3], rgba[3] if len(rgba) > 3 else 255)
+    if (rgba := remarkable_palette.get(color))
+    else None
+    for color in range(max(remarkable_palette) + 1)
+)
+
+# converts the stored direction back to a tilt in radians, inlined in the segment widths
+_TILT_SCALE = math.pi * 2 / 255
+
 
 @dataclass
 class Pen:
@@ -66,11 +78,15 @@ class Pen:
         ), f"base_color must be a tuple of 3 integers: {self.base_color}"
 
         self.segment_length = 1000
+        # whether get_segment_width/get_segment_opacity depend on the point
+        self.is_segment_varying = False
         self.base_opacity = 1
         self.name = "Basic Pen"
         self.stroke_linecap = "round"
         self.stroke_width = self.base_width
         self.stroke_color = self.base_color
+        # formatted once for the SVG writer
+        self.stroke_color_rgb = "rgb(%d, %d, %d)" % self.stroke_color
 
     # note that the units of the points have had their units converted
     # in scene_stream.py
@@ -80,7 +96,7 @@ class Pen:
     # ---> replace tilt with direction_to_tilt() [input]
     @classmethod
     def direction_to_tilt(cls, direction):
-        return direction * (math.pi * 2) / 255
+        return direction * _TILT_SCALE
 
     # width = int(round(d.read_float32() * 4))
     # ---> replace width with width / 4 [input]
@@ -107,7 +123,9 @@ class Pen:
         """must be between 1 and 0"""
         return max(0, min(1, value))
 
+    # pens are never mutated after creation, so strokes with the same settings share one
     @classmethod
+    @lru_cache(maxsize=256)
     def create(cls, pen_nr: PenType, color_id: PenColor, width: float) -> "Pen":
         match pen_nr:
             case PenType.PAINTBRUSH_1 | PenType.PAINTBRUSH_2:
@@ -155,6 +173,7 @@ class Ballpoint(Pen):
         super().__post_init__()
         self.segment_length = 5
         self.name = "Ballpoint"
+        self.is_segment_varying = True
 
     def get_segment_width(
         self, speed: int, direction: int, width: int, pressure: int, last_width: int
@@ -181,12 +200,13 @@ class Marker(Pen):
         super().__post_init__()
         self.segment_length = 3
         self.name = "Marker"
+        self.is_segment_varying = True
 
     def get_segment_width(
         self, speed: int, direction: int, width: int, pressure: int, last_width: int
     ) -> float:
         segment_width = 0.9 * (
-            (width / 4) - 0.4 * self.direction_to_tilt(direction)
+            (width / 4) - 0.4 * direction * _TILT_SCALE
         ) + (0.1 * last_width)
         return segment_width
 
@@ -197,13 +217,14 @@ class Pencil(Pen):
         super().__post_init__()
         self.segment_length = 2
         self.name = "Pencil"
+        self.is_segment_varying = True
 
     def get_segment_width(
         self, speed: int, direction: int, width: int, pressure: int, last_width: int
     ) -> float:
         segment_width = 0.7 * (
             (((0.8 * self.base_width) + (0.5 * pressure / 255)) * (width / 4))
-            - (0.25 * self.direction_to_tilt(direction) ** 1.8)
+            - (0.25 * (direction * _TILT_SCALE) ** 1.8)
             - (0.6 * (speed / 4) / 50)
         )
         # segment_width = 1.3*(((self.base_width * 0.4) * pressure) - 0.5 * ((self.direction_to_tilt(direction) ** 0.5)) + (0.5 * last_width))
@@ -236,13 +257,14 @@ class Brush(Pen):
         self.stroke_linecap = "round"
         self.opacity = 1
         self.name = "Brush"
+        self.is_segment_varying = True
 
     def get_segment_width(
         self, speed: int, direction: int, width: int, pressure: int, last_width: int
     ) -> float:
         segment_width = 0.7 * (
             ((1 + (1.4 * pressure / 255)) * (width / 4))
-            - (0.5 * self.direction_to_tilt(direction))
+            - (0.5 * direction * _TILT_SCALE)
             - ((speed / 4) / 50)
         )  # + (0.2 * last_width)
         return segment_width
@@ -308,12 +330,13 @@ class Caligraphy(Pen):
         super().__post_init__()
         self.segment_length = 2
         self.name = "Calligraphy"
+        self.is_segment_varying = True
 
     def get_segment_width(
         self, speed: int, direction: int, width: int, pressure: int, last_width: int
     ) -> float:
         segment_width = 0.9 * (
             ((1 + pressure / 255) * (width / 4))
-            - 0.3 * self.direction_to_tilt(direction)
+            - 0.3 * direction * _TILT_SCALE
         ) + (0.1 * last_width)
         return segment_width
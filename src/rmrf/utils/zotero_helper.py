@@ -1,16 +1,50 @@
 import logging
 import os
-from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from functools import lru_cache
 from pathlib import Path
 
 import diskcache
 from dotenv import load_dotenv
 from pyzotero import zotero
 
-load_dotenv()
+# Only look for a .env file when the settings are not already in the environment
+if not all(map(os.getenv, ("ZOTERO_USER_ID", "ZOTERO_LIB_KEY", "STORAGE_FOLDER"))):
+    load_dotenv()
 logger = logging.getLogger("rmrf")
 logging.getLogger("urllib3").setLevel(logging.WARNING)
 cache = diskcache.Cache(directory=Path.home() / ".cache" / "rmrf")
+# Lookups are bound by network round-trips, so several run at once
+ZOTERO_LOOKUP_WORKERS = 8
+# Bump when the fields of ZoteroItem change
+ZOTERO_ITEM_CACHE_VERSION = 1
+
+
+# One client per user; the API key stays in memory and out of the on-disk cache keys
+_zotero_clients: dict[str | None, zotero.Zotero] = {}
+
+
+def get_zotero_client(
+    user_id: str | None, lib_key: str | None = None
+) -> zotero.Zotero:
+    """The client of `user_id`, created with `lib_key`, or ZOTERO_LIB_KEY if not given, on first use."""
+    client = _zotero_clients.get(user_id)
+    if client is None:
+        if lib_key is None:
+            lib_key = os.getenv("ZOTERO_LIB_KEY")
+        client = _zotero_clients[user_id] = zotero.Zotero(user_id, "user", lib_key)
+    return client
+
+
+# Not cached themselves: lookup_zotero_fields caches the item built from both calls
+def search_items(user_id: str | None, query: str) -> list[dict]:
+    return get_zotero_client(user_id).items(q=query)
+
+
+def get_children(user_id: str | None, key: str) -> list[dict]:
+    return get_zotero_client(user_id).children(key)
+
 
 @dataclass
 class ZoteroItem:
@@ -28,17 +62,20 @@ class ZoteroLibrary:
         zotero_user_id = os.getenv("ZOTERO_USER_ID")
         zotero_lib_key = os.getenv("ZOTERO_LIB_KEY")
         storage_folder = os.getenv("STORAGE_FOLDER")
-        self.zot = zotero.Zotero(zotero_user_id, "user", zotero_lib_key)
+        self.zotero_user_id = zotero_user_id
+        self.zot = get_zotero_client(zotero_user_id, zotero_lib_key)
         self.storage_folder = Path(storage_folder)
 
-    def lookup_item_and_pdf(self, item_name: str) -> ZoteroItem | None:
-        items = self.zot.items(q=item_name)
+    def lookup_item_and_pdf(
+        self, item_name: str, check_pdf: bool = True
+    ) -> ZoteroItem | None:
+        items = search_items(self.zotero_user_id, item_name)
         if not items:
             logger.warning(f"No items found with the name: [red]{item_name}[/red]")
             return None
 
         item = items[0]
-        attachments = self.zot.children(item["key"])
+        attachments = get_children(self.zotero_user_id, item["key"])
         pdf_attachment = next(
             (
                 att
@@ -55,11 +92,14 @@ class ZoteroLibrary:
             return ZoteroItem(
                 key=item["key"],
                 title=item["data"]["title"],
-                pdf_path=pdf_path if pdf_path.exists() else None,
+                pdf_path=pdf_path if not check_pdf or os.path.isfile(pdf_path) else None,
+                # organisations only carry a single "name" field
                 authors=[
-                    creator["firstName"] + " " + creator["lastName"]
+                    f"{creator['firstName']} {creator['lastName']}"
+                    if "lastName" in creator
+                    else creator.get("name", "")
                     for creator in item["data"]["creators"]
-                    if creator["creatorType"] == "author"
+                    if creator.get("creatorType") == "author"
                 ],
                 abstract=item["data"]["abstractNote"],
                 url=item["data"]["url"],
@@ -69,6 +109,35 @@ class ZoteroLibrary:
         logger.warning(f"No PDF found for item: [red]{item_name}[/red]")
         return None
 
+
+@lru_cache(maxsize=None)
+def get_zotero_library() -> ZoteroLibrary:
+    """The library every lookup goes through, created on first use."""
+    return ZoteroLibrary()
+
+
+# In-process LRU in front of the on-disk cache; both keep negative (None) results.
+# Fields are cached by name as a plain dict, so entries do not pickle the class itself;
+# `version` is part of the key so old entries are never rebuilt into a changed class.
+@lru_cache(maxsize=4096)
 @cache.memoize(typed=True, expire=60 * 60 * 24 * 7)
+def lookup_zotero_fields(item_name: str, version: int) -> dict | None:
+    item = get_zotero_library().lookup_item_and_pdf(item_name, check_pdf=False)
+    return None if item is None else asdict(item)
+
+
 def find_zotero_item(item_name: str) -> ZoteroItem | None:
-    return ZoteroLibrary().lookup_item_and_pdf(item_name)
+    fields = lookup_zotero_fields(item_name, ZOTERO_ITEM_CACHE_VERSION)
+    if fields is None:
+        return None
+    item = ZoteroItem(**fields)
+    # The PDF is checked on every call, so a file synced after the lookup is not cached away
+    if item.pdf_path is not None and not os.path.isfile(item.pdf_path):
+        item.pdf_path = None
+    return item
+
+
+def find_zotero_items(item_names: list[str]) -> list[ZoteroItem | None]:
+    """Look up several items concurrently; results are in the order of `item_names`."""
+    with ThreadPoolExecutor(max_workers=ZOTERO_LOOKUP_WORKERS) as executor:
+        return list(executor.map(find_zotero_item, item_names))
@@ -1,5 +1,6 @@
-import inspect
-from types import FrameType
+import sys
+from functools import lru_cache
+from types import CodeType, FrameType
 from typing import BinaryIO
 
 from rmscene.scene_stream import read_blocks
@@ -12,39 +13,68 @@ def current_stack_trace():
         List[FrameType]: A list of frame objects representing the current call stack,
         ordered from oldest (bottom) to most recent (top).
     """
-    frames = inspect.stack()
-    call_stack = []
+    # Walking the frames directly skips the source context inspect.stack() reads for each one
+    frame = sys._getframe(1)
+    frames = []
     started = False
 
-    for frame in frames:
-        function = frame.function
-        if "self" in frame.frame.f_locals:
-            full_name = f"{frame.frame.f_locals['self'].__class__.__name__}.{function}"
-        else:
-            full_name = function
-        if not started and full_name != "HookedStream.read":
-            continue
-        started = True
-        if full_name == "HookedStream.read":
-            continue
-        if function == "read_blocks":
-            break
-        call_stack.append(full_name)
-    
+    while frame is not None:
+        code = frame.f_code
+        # Code objects identify HookedStream.read without building f_locals
+        if code is _HOOKED_READ_CODE:
+            started = True
+        elif started:
+            if code.co_name == "read_blocks":
+                break
+            frames.append(frame)
+        frame = frame.f_back
+
+    # The same code can run on instances of different classes, so the class is part of the key;
+    # f_locals is only built for frames of functions whose first argument is self
+    key = tuple(
+        (
+            code,
+            frame.f_locals["self"].__class__
+            if code.co_argcount and code.co_varnames[0] == "self"
+            else None,
+        )
+        for frame in frames
+        for code in (frame.f_code,)
+    )
+    call_stack = list(_call_stack_names(key))
+
     # print(" -> ".join(call_stack))
     return call_stack
 
+
+@lru_cache(maxsize=1024)
+def _call_stack_names(key: tuple[tuple[CodeType, type | None], ...]) -> tuple[str, ...]:
+    """Names of a call stack, shared by every read from the same call site."""
+    return tuple(
+        f"{cls.__name__}.{code.co_name}" if cls is not None else code.co_name
+        for code, cls in key
+    )
+
+
 class HookedStream:
 
-    def __init__(self, f: str | BinaryIO):
+    def __init__(self, f: str | BinaryIO, capture_traces: bool = False):
         self.fh = open(f, "rb") if isinstance(f, str) else f
+        # Walking the stack on every read is only worth it when the traces are inspected
+        self.capture_traces = capture_traces
         self.traces = []
+        # Everything read so far from the start of the stream, as long as reads are contiguous;
+        # only kept alongside the traces, which is when hooked_read slices blocks out of it
+        self.data = bytearray()
 
     def read(self, size: int, silent: bool = False) -> bytes:
+        offset = self.fh.tell()
         data = self.fh.read(size)
-        if not silent:
+        if self.capture_traces and offset == len(self.data):
+            self.data += data
+        if self.capture_traces and not silent:
             frames = current_stack_trace()
-            self.traces.append(("read", size, data.hex(), frames))
+            self.traces.append(("read", size, data, frames))
         return data
 
     def tell(self) -> int:
@@ -56,21 +86,29 @@ class HookedStream:
     def close(self) -> None:
         return self.fh.close()
     
-    def all_traces(self) -> list[tuple[str, int, str, list[str]]]:
+    def all_traces(self) -> list[tuple[str, int, bytes, list[str]]]:
         results = self.traces
         self.traces = []
         return results
 
 
-def hooked_read(f: str | BinaryIO) -> list[tuple[type, int, int, str, list[tuple[str, int, str, list[str]]]]]:
+_HOOKED_READ_CODE = HookedStream.read.__code__
+
+
+def hooked_read(f: str | BinaryIO) -> list[tuple[type, int, int, bytes, list[tuple[str, int, bytes, list[str]]]]]:
     results = []
     start = 0
-    fh = HookedStream(f)
+    fh = HookedStream(f, capture_traces=True)
     for block in read_blocks(fh):
         end = fh.tell()
         traces = fh.all_traces()
-        fh.seek(start)
-        results.append((block, start, end, fh.read(end - start, silent=True).hex(), traces))
+        if end <= len(fh.data):
+            # The block was read in one contiguous run, so its bytes are already at hand
+            data = bytes(fh.data[start:end])
+        else:
+            fh.seek(start)
+            data = fh.read(end - start, silent=True)
+        results.append((block, start, end, data, traces))
         start = end
     fh.close()
     return results
@@ -1,8 +1,12 @@
 from itertools import groupby
+from operator import itemgetter
 
 import gradio as gr
 from hooked_stream import hooked_read
 
+# Maps every byte to itself if printable ASCII, otherwise to "."
+PRINTABLE_TABLE = bytes(c if 32 <= c <= 126 else ord(".") for c in range(256))
+
 
 def render_binary_file(file: gr.File) -> tuple[str, str]:
     """
@@ -21,34 +25,36 @@ def render_binary_file(file: gr.File) -> tuple[str, str]:
         blocks = hooked_read(file.name)
         
         # Generate hex dump
-        hex_dump = ""
-        block_analysis = ""
+        # Collected as fragments and joined once at the end
+        hex_dump = []
+        block_analysis = []
         
-        for i, (block, start, end, hex_data, traces) in enumerate(blocks):
+        for i, (block, start, end, data, traces) in enumerate(blocks):
             block_name = type(block).__name__
             
             # Format block info
-            block_analysis += f"Block {i}: {block_name}\n"
-            block_analysis += f"Start: {start}, End: {end}, Size: {end-start} bytes\n"
-            for call_stack, traces in groupby(traces, key=lambda x: " -> ".join(x[-1])):
-                block_analysis += f"  {call_stack}\n"
-                for trace in traces:
-                    _, read_size, subblock_hex, frames = trace
-                    block_analysis += f"    read {read_size} bytes {len(frames)} frames\n"
+            block_analysis.append(f"Block {i}: {block_name}\n")
+            block_analysis.append(f"Start: {start}, End: {end}, Size: {end-start} bytes\n")
+            # Each call stack is joined once, and the groups no longer shadow `traces`
+            keyed = [(" -> ".join(trace[-1]), trace) for trace in traces]
+            for call_stack, group in groupby(keyed, key=itemgetter(0)):
+                block_analysis.append(f"  {call_stack}\n")
+                for _, trace in group:
+                    _, read_size, subblock_data, frames = trace
+                    block_analysis.append(f"    read {read_size} bytes {len(frames)} frames\n")
                 # for frame in frames:
-                #     block_analysis += f"    {frame}\n"
-            block_analysis += "-" * 50 + "\n"
+                #     block_analysis.append(f"    {frame}\n")
+            block_analysis.append("-" * 50 + "\n")
             
             # Format hex dump with line numbers and ASCII
-            hex_dump += f"\n=== Block {i}: {block_name} ===\n"
-            for j in range(0, len(hex_data), 32):
-                line = hex_data[j:j+32]
-                offset = j//2
-                ascii_chars = ''.join(chr(int(line[i:i+2], 16)) if 32 <= int(line[i:i+2], 16) <= 126 else '.' 
-                                    for i in range(0, len(line), 2))
-                hex_dump += f"{offset:08x}: {' '.join(line[i:i+2] for i in range(0, len(line), 2)):48s}  {ascii_chars}\n"
+            hex_dump.append(f"\n=== Block {i}: {block_name} ===\n")
+            # Raw bytes are kept until here, so only the dumped rows are hex-encoded
+            for offset in range(0, len(data), 16):
+                row = data[offset:offset+16]
+                ascii_chars = row.translate(PRINTABLE_TABLE).decode("ascii")
+                hex_dump.append(f"{offset:08x}: {row.hex(' '):48s}  {ascii_chars}\n")
                 
-        return hex_dump, block_analysis
+        return "".join(hex_dump), "".join(block_analysis)
         
     except Exception as e:
         return f"Error processing file: {str(e)}", ""